@@ -617,7 +617,8 @@ class TableBase(MutableMapping):
             v = ct_values[i]
             if not isinstance(k, ct.Structure):
                 k = self.Key(k)
-            if not isinstance(v, ct.Structure):
+            # per-CPU maps already yield a ct.Array of per-CPU values
+            if not isinstance(v, (ct.Structure, ct.Array)):
                 v = self.Leaf(v)
             yield (k, v)
 
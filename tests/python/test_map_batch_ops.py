@@ -141,6 +141,38 @@ class TestMapBatch(TestCase):
 
         self.assertEqual(i, self.SUBSET_SIZE)
 
+    def test_lookup_and_delete_batch_percpu_hash(self):
+        b = BPF(text=b"""
+        struct val_t {
+            u64 count;
+            u64 size;
+        };
+        BPF_PERCPU_HASH(map, int, struct val_t, %d);
+        """ % self.MAPSIZE)
+        hmap = b[b"map"]
+        for i in range(0, self.MAPSIZE):
+            leaf = hmap.Leaf()
+            for c in range(0, hmap.total_cpu):
+                leaf[c].count = i
+                leaf[c].size = c
+            hmap[ct.c_int(i)] = leaf
+
+        # each value is the array of per-CPU values
+        i = 0
+        for k, v in sorted(hmap.items_lookup_and_delete_batch(),
+                           key=lambda kv:kv[0].value):
+            self.assertEqual(k.value, i)
+            self.assertEqual(len(v), hmap.total_cpu)
+            for c in range(0, hmap.total_cpu):
+                self.assertEqual(v[c].count, i)
+                self.assertEqual(v[c].size, c)
+            i += 1
+        self.assertEqual(i, self.MAPSIZE)
+
+        # and check the delete has worked, i.e map is now empty
+        count = sum(1 for _ in hmap.items())
+        self.assertEqual(count, 0)
+
 
 if __name__ == "__main__":
     main()
@@ -4,6 +4,7 @@
 
 from bcc import BPF, _get_num_open_probes, TRACEFS
 import os
+import re
 import sys
 from unittest import main, TestCase
 
@@ -17,11 +18,8 @@ class TestKprobeCnt(TestCase):
         self.b.attach_kprobe(event_re=b"^vfs_.*", fn_name=b"wololo")
 
     def test_attach1(self):
-        actual_cnt = 0
         with open("%s/available_filter_functions" % TRACEFS, "rb") as f:
-            for line in f:
-                if line.startswith(b"vfs_"):
-                    actual_cnt += 1
+            actual_cnt = len(re.findall(b"(?m)^vfs_", f.read()))
         open_cnt = self.b.num_open_kprobes()
         self.assertEqual(actual_cnt, open_cnt)
 
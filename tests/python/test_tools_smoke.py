@@ -7,6 +7,7 @@ import os
 import re
 from unittest import main, skipUnless, TestCase
 from utils import mayFail, kernel_version_ge
+from bcc import BPF
 
 TOOLS_DIR = "/bcc/tools/"
 
@@ -312,6 +313,18 @@ class SmokeTests(TestCase):
     def test_slabratetop(self):
         self.run_with_duration("slabratetop.py 1 1")
 
+    def test_slabratetop_kprobe(self):
+        self.run_with_duration("slabratetop.py --attach kprobe 1 1")
+
+    @skipUnless(BPF.support_kfunc(), "requires fentry support")
+    def test_slabratetop_fentry(self):
+        self.run_with_duration("slabratetop.py --attach fentry 1 1")
+
+    @skipUnless(kernel_version_ge(6,1) and BPF.support_raw_tracepoint(),
+                "requires kernel >= 6.1")
+    def test_slabratetop_raw_tp(self):
+        self.run_with_duration("slabratetop.py --attach raw_tp 1 1")
+
     @skipUnless(kernel_version_ge(4,7), "requires kernel >= 4.7")
     def test_softirqs(self):
         self.run_with_duration("softirqs.py 1 1")
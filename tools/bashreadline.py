@@ -19,7 +19,7 @@
 from __future__ import print_function
 from elftools.elf.elffile import ELFFile
 from bcc import BPF
-from time import strftime
+from time import localtime, strftime, time
 import argparse
 
 parser = argparse.ArgumentParser(
@@ -56,26 +56,45 @@ struct str_t {
     char str[80];
 };
 
-BPF_PERF_OUTPUT(events);
+PERF_TABLE
 
 int printret(struct pt_regs *ctx) {
-    struct str_t data  = {};
     char comm[TASK_COMM_LEN] = {};
     if (!PT_REGS_RC(ctx))
         return 0;
-    data.pid = bpf_get_current_pid_tgid() >> 32;
-    bpf_probe_read_user(&data.str, sizeof(data.str), (void *)PT_REGS_RC(ctx));
 
     bpf_get_current_comm(&comm, sizeof(comm));
-    if (comm[0] == 'b' && comm[1] == 'a' && comm[2] == 's' && comm[3] == 'h' && comm[4] == 0 ) {
-        events.perf_submit(ctx,&data,sizeof(data));
-    }
+    if (comm[0] != 'b' || comm[1] != 'a' || comm[2] != 's' || comm[3] != 'h' || comm[4] != 0)
+        return 0;
 
+    DATA_ALLOC
+    data->pid = bpf_get_current_pid_tgid() >> 32;
+    bpf_probe_read_user(&data->str, sizeof(data->str), (void *)PT_REGS_RC(ctx));
+    PERF_OUTPUT_CTX
 
     return 0;
 };
 """
 
+if BPF.kernel_struct_has_field(b'bpf_ringbuf', b'waitq') == 1:
+    PERF_MODE = "USE_BPF_RING_BUF"
+    bpf_text = bpf_text.replace('PERF_TABLE',
+                                'BPF_RINGBUF_OUTPUT(events, 8);')
+    # reserve the event in the ring buffer and fill it in place
+    bpf_text = bpf_text.replace('DATA_ALLOC',
+        'struct str_t *data = events.ringbuf_reserve(sizeof(struct str_t));\n' +
+        '    if (!data)\n' +
+        '        return 0;')
+    bpf_text = bpf_text.replace('PERF_OUTPUT_CTX',
+                                'events.ringbuf_submit(data, 0);')
+else:
+    PERF_MODE = "USE_BPF_PERF_BUF"
+    bpf_text = bpf_text.replace('PERF_TABLE', 'BPF_PERF_OUTPUT(events);')
+    bpf_text = bpf_text.replace('DATA_ALLOC',
+                                'struct str_t __data = {}, *data = &__data;')
+    bpf_text = bpf_text.replace('PERF_OUTPUT_CTX',
+                                'events.perf_submit(ctx, data, sizeof(*data));')
+
 b = BPF(text=bpf_text)
 b.attach_uretprobe(name=name, sym=sym, fn_name="printret")
 
@@ -83,15 +102,33 @@ b.attach_uretprobe(name=name, sym=sym, fn_name="printret")
 print("%-9s %-7s %s" % ("TIME", "PID", "COMMAND"))
 
 
+# cached "%H:%M:%S" string, only reformatted when the second changes
+last_time = [0, ""]
+
+
+def timestamp():
+    now = int(time())
+    if now != last_time[0]:
+        last_time[0] = now
+        last_time[1] = strftime("%H:%M:%S", localtime(now))
+    return last_time[1]
+
+
 def print_event(cpu, data, size):
     event = b["events"].event(data)
-    print("%-9s %-7d %s" % (strftime("%H:%M:%S"), event.pid,
+    print("%-9s %-7d %s" % (timestamp(), event.pid,
                             event.str.decode('utf-8', 'replace')))
 
 
-b["events"].open_perf_buffer(print_event)
+if PERF_MODE == "USE_BPF_RING_BUF":
+    b["events"].open_ring_buffer(print_event)
+else:
+    b["events"].open_perf_buffer(print_event)
 while 1:
     try:
-        b.perf_buffer_poll()
+        if PERF_MODE == "USE_BPF_RING_BUF":
+            b.ring_buffer_poll()
+        else:
+            b.perf_buffer_poll()
     except KeyboardInterrupt:
         exit()
@@ -14,10 +14,13 @@
 from __future__ import print_function
 from bcc import BPF
 from time import sleep
+from functools import lru_cache
+from operator import itemgetter
+import heapq
 import argparse
 import signal
 import errno
-from sys import stderr
+from sys import stderr, stdout
 
 # arg validation
 def positive_int(val):
@@ -68,6 +71,7 @@ examples = """examples:
     ./offwaketime -f 5        # 5 seconds, and output in folded format
     ./offwaketime -m 1000     # trace only events that last more than 1000 usec
     ./offwaketime -M 9000     # trace only events that last less than 9000 usec
+    ./offwaketime --top 10    # only show the 10 stacks with the most blocked time
     ./offwaketime -p 185      # only trace threads for PID 185
     ./offwaketime -t 188      # only trace thread 188
     ./offwaketime -u          # only trace user threads (no kernel)
@@ -116,6 +120,8 @@ parser.add_argument("-M", "--max-block-time", default=(1 << 64) - 1,
     type=positive_nonzero_int,
     help="the amount of time in microseconds under which we " +
          "store traces (default U64_MAX)")
+parser.add_argument("--top", type=positive_nonzero_int,
+    help="only show the TOP stacks with the most blocked time")
 parser.add_argument("--state", type=_positive_int,
     help="filter on this thread state bitmask (eg, 2 == TASK_UNINTERRUPTIBLE" +
          ") see include/linux/sched.h")
@@ -149,11 +155,11 @@ struct key_t {
     u32 w_pid;
     u32 w_tgid;
 };
-BPF_HASH(counts, struct key_t);
+BPF_TABLE("lru_hash", struct key_t, u64, counts, 65536);
 
 // Key of this hash is PID of waiting Process,
 // value is timestamp when it went into waiting
-BPF_HASH(start, u32);
+BPF_TABLE("lru_hash", u32, u64, start, 10240);
 
 struct wokeby_t {
     char name[TASK_COMM_LEN];
@@ -164,7 +170,7 @@ struct wokeby_t {
 };
 // Key of the hash is PID of the Process to be waken, value is information
 // of the Process who wakes it
-BPF_HASH(wokeby, u32, struct wokeby_t);
+BPF_TABLE("lru_hash", u32, struct wokeby_t, wokeby, 10240);
 
 BPF_STACK_TRACE(stack_traces, STACK_STORAGE_SIZE);
 
@@ -182,8 +188,9 @@ int waker(struct pt_regs *ctx, struct task_struct *p) {
     bpf_get_current_comm(&woke.name, sizeof(woke.name));
     woke.k_stack_id = KERNEL_STACK_GET;
     woke.u_stack_id = USER_STACK_GET;
-    woke.w_pid = bpf_get_current_pid_tgid();
-    woke.w_tgid = bpf_get_current_pid_tgid() >> 32;
+    u64 pid_tgid = bpf_get_current_pid_tgid();
+    woke.w_pid = pid_tgid;
+    woke.w_tgid = pid_tgid >> 32;
 
     wokeby.update(&pid, &woke);
     return 0;
@@ -204,8 +211,9 @@ int oncpu(struct pt_regs *ctx, struct task_struct *p) {
     // Calculate current Process's wait time by finding the timestamp of when
     // it went into waiting.
     // pid and tgid are now the PID and TGID of the current (waking) Process.
-    pid = bpf_get_current_pid_tgid();
-    tgid = bpf_get_current_pid_tgid() >> 32;
+    u64 pid_tgid = bpf_get_current_pid_tgid();
+    pid = pid_tgid;
+    tgid = pid_tgid >> 32;
     tsp = start.lookup(&pid);
     if (tsp == 0) {
         // Missed or filtered when the Process went into waiting
@@ -243,7 +251,8 @@ int oncpu(struct pt_regs *ctx, struct task_struct *p) {
 }
 """
 
-# set thread filter
+# set thread filter: this applies to both the wakee in waker() and the
+# Process going off-CPU in oncpu(), so -p/-t also skip unrelated wakeups
 if args.tgid is not None:
     thread_filter = build_filter("tgid", args.tgid)
 elif args.pid is not None:
@@ -300,6 +309,9 @@ matched = b.num_open_kprobes()
 if matched == 0:
     print("0 functions traced. Exiting.")
     exit()
+# check whether hash table batch ops is supported
+htab_batch_ops = True if BPF.kernel_struct_has_field(b'bpf_map_ops',
+        b'map_lookup_and_delete_batch') == 1 else False
 
 # header
 if not folded:
@@ -327,7 +339,26 @@ counts = b.get_table("counts")
 stack_traces = b.get_table("stack_traces")
 need_delimiter = args.delimited and not (args.kernel_stacks_only or
                                          args.user_stacks_only)
-for k, v in sorted(counts.items(), key=lambda counts: counts[1].value):
+
+# the same frames recur across many keys, so memoize symbol lookups
+@lru_cache(maxsize=65536)
+def sym(addr, tgid):
+    return b.sym(addr, tgid)
+
+@lru_cache(maxsize=65536)
+def ksym(addr):
+    return b.ksym(addr)
+
+folded_lines = []
+pairs = counts.items_lookup_batch() if htab_batch_ops else counts.items()
+if args.top:
+    # partial sort: O(n log top), still printed in ascending order
+    top = heapq.nlargest(args.top, ((k, v.value) for k, v in pairs),
+                         key=itemgetter(1))
+    top.reverse()
+else:
+    top = sorted(((k, v.value) for k, v in pairs), key=itemgetter(1))
+for k, value in top:
     # handle get_stackid errors
     if not args.user_stacks_only:
         missing_stacks += int(stack_id_err(k.w_k_stack_id))
@@ -340,14 +371,15 @@ for k, v in sorted(counts.items(), key=lambda counts: counts[1].value):
         has_enomem = has_enomem or (k.w_u_stack_id == -errno.ENOMEM) or \
                      (k.t_u_stack_id == -errno.ENOMEM)
 
+    # walk each stack once; the waker stacks skip their first frame
     waker_user_stack = [] if k.w_u_stack_id < 1 else \
-        reversed(list(stack_traces.walk(k.w_u_stack_id))[1:])
+        list(stack_traces.walk(k.w_u_stack_id))[1:]
     waker_kernel_stack = [] if k.w_k_stack_id < 1 else \
-        reversed(list(stack_traces.walk(k.w_k_stack_id))[1:])
+        list(stack_traces.walk(k.w_k_stack_id))[1:]
     target_user_stack = [] if k.t_u_stack_id < 1 else \
-        stack_traces.walk(k.t_u_stack_id)
+        list(stack_traces.walk(k.t_u_stack_id))
     target_kernel_stack = [] if k.t_k_stack_id < 1 else \
-        stack_traces.walk(k.t_k_stack_id)
+        list(stack_traces.walk(k.t_k_stack_id))
 
     if folded:
         # print folded stack output
@@ -356,31 +388,33 @@ for k, v in sorted(counts.items(), key=lambda counts: counts[1].value):
             if stack_id_err(k.t_u_stack_id):
                 line.append("[Missed User Stack] %d" % k.t_u_stack_id)
             else:
-                line.extend([b.sym(addr, k.t_tgid).decode('utf-8', 'replace')
-                    for addr in reversed(list(target_user_stack)[1:])])
+                line.extend(sym(addr, k.t_tgid).decode('utf-8', 'replace')
+                    for addr in target_user_stack[:0:-1])
         if not args.user_stacks_only:
-            line.extend(["-"] if (need_delimiter and k.t_k_stack_id > 0 and k.t_u_stack_id > 0) else [])
+            if need_delimiter and k.t_k_stack_id > 0 and k.t_u_stack_id > 0:
+                line.append("-")
             if stack_id_err(k.t_k_stack_id):
                 line.append("[Missed Kernel Stack]")
             else:
-                line.extend([b.ksym(addr).decode('utf-8', 'replace')
-                    for addr in reversed(list(target_kernel_stack)[1:])])
+                line.extend(ksym(addr).decode('utf-8', 'replace')
+                    for addr in target_kernel_stack[:0:-1])
         line.append("--")
         if not args.user_stacks_only:
             if stack_id_err(k.w_k_stack_id):
                 line.append("[Missed Kernel Stack]")
             else:
-                line.extend([b.ksym(addr).decode('utf-8', 'replace')
-                    for addr in reversed(list(waker_kernel_stack))])
+                line.extend(ksym(addr).decode('utf-8', 'replace')
+                    for addr in waker_kernel_stack)
         if not args.kernel_stacks_only:
-            line.extend(["-"] if (need_delimiter and k.w_u_stack_id > 0 and k.w_k_stack_id > 0) else [])
+            if need_delimiter and k.w_u_stack_id > 0 and k.w_k_stack_id > 0:
+                line.append("-")
             if stack_id_err(k.w_u_stack_id):
                 line.append("[Missed User Stack]")
             else:
-                line.extend([b.sym(addr, k.w_tgid).decode('utf-8', 'replace')
-                    for addr in reversed(list(waker_user_stack))])
+                line.extend(sym(addr, k.w_tgid).decode('utf-8', 'replace')
+                    for addr in waker_user_stack)
         line.append(k.waker.decode('utf-8', 'replace'))
-        print("%s %d" % (";".join(line), v.value))
+        folded_lines.append("%s %d" % (";".join(line), value))
     else:
         # print wakeup name then stack in reverse order
         print("    %-16s %s %s" % ("waker:", k.waker.decode('utf-8', 'replace'), k.w_pid))
@@ -388,16 +422,16 @@ for k, v in sorted(counts.items(), key=lambda counts: counts[1].value):
             if stack_id_err(k.w_u_stack_id):
                 print("    [Missed User Stack] %d" % k.w_u_stack_id)
             else:
-                for addr in waker_user_stack:
-                    print("    %s" % b.sym(addr, k.w_tgid).decode('utf-8', 'replace'))
+                for addr in reversed(waker_user_stack):
+                    print("    %s" % sym(addr, k.w_tgid).decode('utf-8', 'replace'))
         if not args.user_stacks_only:
             if need_delimiter and k.w_u_stack_id > 0 and k.w_k_stack_id > 0:
                 print("    -")
             if stack_id_err(k.w_k_stack_id):
                 print("    [Missed Kernel Stack]")
             else:
-                for addr in waker_kernel_stack:
-                    print("    %s" % b.ksym(addr).decode('utf-8', 'replace'))
+                for addr in reversed(waker_kernel_stack):
+                    print("    %s" % ksym(addr).decode('utf-8', 'replace'))
 
         # print waker/wakee delimiter
         print("    %-16s %s" % ("--", "--"))
@@ -407,7 +441,7 @@ for k, v in sorted(counts.items(), key=lambda counts: counts[1].value):
                 print("    [Missed Kernel Stack]")
             else:
                 for addr in target_kernel_stack:
-                    print("    %s" % b.ksym(addr).decode('utf-8', 'replace'))
+                    print("    %s" % ksym(addr).decode('utf-8', 'replace'))
         if not args.kernel_stacks_only:
             if need_delimiter and k.t_u_stack_id > 0 and k.t_k_stack_id > 0:
                 print("    -")
@@ -415,9 +449,13 @@ for k, v in sorted(counts.items(), key=lambda counts: counts[1].value):
                 print("    [Missed User Stack]")
             else:
                 for addr in target_user_stack:
-                    print("    %s" % b.sym(addr, k.t_tgid).decode('utf-8', 'replace'))
+                    print("    %s" % sym(addr, k.t_tgid).decode('utf-8', 'replace'))
         print("    %-16s %s %s" % ("target:", k.target.decode('utf-8', 'replace'), k.t_pid))
-        print("        %d\n" % v.value)
+        print("        %d\n" % value)
+
+if folded_lines:
+    # emit the folded report with a single write
+    stdout.write("\n".join(folded_lines) + "\n")
 
 if missing_stacks > 0:
     enomem_str = " Consider increasing --stack-storage-size."
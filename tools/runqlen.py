@@ -23,6 +23,7 @@ from __future__ import print_function
 from bcc import BPF, PerfType, PerfSWConfig, utils
 from time import sleep, strftime
 from tempfile import NamedTemporaryFile
+from collections import defaultdict
 from os import open, close, dup, unlink, O_WRONLY
 import argparse
 
@@ -164,7 +165,13 @@ int do_perf_event()
 """
 
 # code substitutions
-if args.cpus:
+if args.runqocc and not args.cpus:
+    # system-wide occupancy only needs idle vs. queued sample counts
+    bpf_text = bpf_text.replace('STORAGE',
+        'BPF_PERCPU_ARRAY(dist, u64, 2);')
+    bpf_text = bpf_text.replace('STORE', 'u32 idx = len ? 1 : 0; ' +
+        'u64 *c = dist.lookup(&idx); if (c) (*c)++;')
+elif args.cpus:
     bpf_text = bpf_text.replace('STORAGE',
         'BPF_HISTOGRAM(dist, cpu_key_t, MAX_CPUS);')
     bpf_text = bpf_text.replace('STORE', 'cpu_key_t key = {.slot = len}; ' +
@@ -195,6 +202,9 @@ b = BPF(text=bpf_text, cflags=['-DMAX_CPUS=%s' % str(num_cpus)])
 b.attach_perf_event(ev_type=PerfType.SOFTWARE,
     ev_config=PerfSWConfig.CPU_CLOCK, fn_name="do_perf_event",
     sample_period=0, sample_freq=frequency)
+# check whether map batch ops is supported
+map_batch_ops = True if BPF.kernel_struct_has_field(b'bpf_map_ops',
+        b'map_lookup_and_delete_batch') == 1 else False
 
 print("Sampling run queue length... Hit Ctrl-C to end.")
 
@@ -214,37 +224,24 @@ while (1):
     if args.runqocc:
         if args.cpus:
             # run queue occupancy, per-CPU summary
-            idle = {}
-            queued = {}
-            cpumax = 0
-            for k, v in dist.items():
-                if k.cpu > cpumax:
-                    cpumax = k.cpu
-            for c in range(0, cpumax + 1):
-                idle[c] = 0
-                queued[c] = 0
-            for k, v in dist.items():
-                if k.slot == 0:
-                    idle[k.cpu] += v.value
-                else:
-                    queued[k.cpu] += v.value
+            stats = defaultdict(lambda: [0, 0])   # cpu -> [idle, queued]
+            for k, v in (dist.items_lookup_batch() if map_batch_ops
+                         else dist.items()):
+                stats[k.cpu][0 if k.slot == 0 else 1] += v.value
+            cpumax = max(stats) if stats else 0
             for c in range(0, cpumax + 1):
-                samples = idle[c] + queued[c]
+                idle, queued = stats[c]
+                samples = idle + queued
                 if samples:
-                    runqocc = float(queued[c]) / samples
+                    runqocc = float(queued) / samples
                 else:
                     runqocc = 0
                 print("runqocc, CPU %-3d %6.2f%%" % (c, 100 * runqocc))
 
         else:
             # run queue occupancy, system-wide summary
-            idle = 0
-            queued = 0
-            for k, v in dist.items():
-                if k.value == 0:
-                    idle += v.value
-                else:
-                    queued += v.value
+            idle = dist.sum(0).value
+            queued = dist.sum(1).value
             samples = idle + queued
             if samples:
                 runqocc = float(queued) / samples
@@ -8,6 +8,11 @@
 #
 # This uses in-kernel BPF maps to store cache summaries for efficiency.
 #
+# Allocations are traced with fentry where available, else the
+# kmem:kmem_cache_alloc raw tracepoint (Linux 6.1+), else kprobes. All modes
+# count kmem_cache_alloc(), kmem_cache_alloc_lru() and kmem_cache_alloc_node()
+# calls, where those functions exist.
+#
 # SEE ALSO: slabtop(1), which shows the cache volumes.
 #
 # Copyright 2016 Netflix, Inc.
@@ -22,8 +27,10 @@ from __future__ import print_function
 from bcc import BPF
 from bcc.utils import printb
 from time import sleep, strftime
-import argparse, platform
+from operator import itemgetter
+import argparse, heapq, platform
 from subprocess import call
+import os
 
 rel = platform.release().split('.')
 if int(rel[0]) > 6 or (int(rel[0]) == 6 and int(rel[1]) >= 8):
@@ -52,6 +59,9 @@ parser.add_argument("count", nargs="?", default=99999999,
     help="number of outputs")
 parser.add_argument("--ebpf", action="store_true",
     help=argparse.SUPPRESS)
+# force an attach mode instead of picking the best supported one (for testing)
+parser.add_argument("--attach", choices=["fentry", "raw_tp", "kprobe"],
+    help=argparse.SUPPRESS)
 args = parser.parse_args()
 interval = int(args.interval)
 countdown = int(args.count)
@@ -62,6 +72,15 @@ debug = 0
 # linux stats
 loadavg = "/proc/loadavg"
 
+# output formats
+header = "%-32s %6s %10s" % ("CACHE", "ALLOCS", "BYTES")
+row_fmt = b"%-32s %6d %10d"
+
+# home the cursor and clear the screen without running clear(1) on every
+# interval; terminals without a known type still go through clear(1)
+clear_seq = b"\x1b[H\x1b[2J"
+ansi_clear = os.environ.get("TERM", "dumb") != "dumb"
+
 # define BPF program
 bpf_text = """
 #include <uapi/linux/ptrace.h>
@@ -169,9 +188,9 @@ typedef union {
 
 #define CACHE_NAME_SIZE 32
 
-// the key for the output summary
+// the key for the output summary: the kmem_cache pointer
 struct info_t {
-    char name[CACHE_NAME_SIZE];
+    u64 cache;
 };
 
 // the value of the output summary
@@ -180,24 +199,111 @@ struct val_t {
     u64 size;
 };
 
-BPF_HASH(counts, struct info_t, struct val_t);
+// cache names, recorded on the first allocation from a cache in each interval
+// rather than on every allocation. This is an LRU hash so that entries for
+// destroyed caches age out instead of filling the map.
+struct name_t {
+    char name[CACHE_NAME_SIZE];
+};
+
+// per-CPU values, sized for the number of slab caches rather than the
+// default 10240 entries. Not preallocated, so that an element re-used after
+// the interval's lookup-and-delete starts zeroed on every CPU.
+BPF_F_TABLE("percpu_hash", struct info_t, struct val_t, counts, 2048,
+            BPF_F_NO_PREALLOC);
+BPF_TABLE("lru_hash", struct info_t, struct name_t, names, 10240);
 
-int kprobe__kmem_cache_alloc(struct pt_regs *ctx, struct kmem_cache *cachep)
+// read a kmem_cache field into dst
+#define READ_CACHE(dst, cachep, field) READ_CACHE_FIELD
+
+static __always_inline int count_alloc(struct kmem_cache *cachep)
 {
-    struct info_t info = {};
-    const char *name = cachep->name;
-    bpf_probe_read_kernel(&info.name, sizeof(info.name), name);
+    struct info_t info = {.cache = (u64)cachep};
+    unsigned int size;
+
+    READ_CACHE(size, cachep, size);
 
-    struct val_t *valp, zero = {};
-    valp = counts.lookup_or_try_init(&info, &zero);
+    struct val_t *valp = counts.lookup(&info);
     if (valp) {
         valp->count++;
-        valp->size += cachep->size;
+        valp->size += size;
+        return 0;
     }
 
+    // first allocation from this cache in this interval: record its name
+    struct name_t name = {};
+    const char *namep;
+    READ_CACHE(namep, cachep, name);
+    bpf_probe_read_kernel(&name.name, sizeof(name.name), namep);
+    names.update(&info, &name);
+
+    // this only sets the current CPU's value, which is still zero if
+    // another CPU created the entry in the meantime
+    struct val_t val = {.count = 1, .size = size};
+    counts.update(&info, &val);
+
     return 0;
 }
 """
+
+bpf_text_kprobe = """
+int trace_cache_alloc(struct pt_regs *ctx, struct kmem_cache *cachep)
+{
+    return count_alloc(cachep);
+}
+"""
+
+bpf_text_raw_tp = """
+RAW_TRACEPOINT_PROBE(kmem_cache_alloc)
+{
+    // TP_PROTO(unsigned long call_site, const void *ptr,
+    //          struct kmem_cache *s, gfp_t gfp_flags, int node)
+    return count_alloc((struct kmem_cache *)ctx->args[2]);
+}
+"""
+
+bpf_text_kfunc = """
+KFUNC_PROBE(FUNCNAME, struct kmem_cache *cachep)
+{
+    return count_alloc(cachep);
+}
+"""
+
+# Since Linux 6.1 the kmem_cache_alloc tracepoint also fires from
+# kmem_cache_alloc_lru() and kmem_cache_alloc_node(), so the fentry and kprobe
+# modes trace those too, where they exist, to count the same allocations.
+alloc_funcs = ["kmem_cache_alloc"]
+for func in ["kmem_cache_alloc_lru", "kmem_cache_alloc_node"]:
+    if BPF.get_kprobe_functions(b"^%s$" % func.encode()):
+        alloc_funcs.append(func)
+
+# prefer fentry, then the raw tracepoint, which only passes the cache
+# pointer since Linux 6.1, and fall back to a kprobe
+is_support_kfunc = BPF.support_kfunc()
+is_support_raw_tp = (int(rel[0]), int(rel[1])) >= (6, 1) and \
+    BPF.support_raw_tracepoint() and \
+    BPF.tracepoint_exists("kmem", "kmem_cache_alloc")
+if args.attach:
+    if (args.attach == "fentry" and not is_support_kfunc) or \
+            (args.attach == "raw_tp" and not is_support_raw_tp):
+        print("ERROR: attach mode %s is not supported by this kernel." %
+              args.attach)
+        exit(1)
+    is_support_kfunc = args.attach == "fentry"
+    is_support_raw_tp = args.attach == "raw_tp"
+if is_support_kfunc:
+    for func in alloc_funcs:
+        bpf_text += bpf_text_kfunc.replace('FUNCNAME', func)
+    # fentry arguments are BTF-typed, so the verifier allows direct loads
+    bpf_text = bpf_text.replace('READ_CACHE_FIELD', 'dst = cachep->field')
+else:
+    if is_support_raw_tp:
+        bpf_text += bpf_text_raw_tp
+    else:
+        bpf_text += bpf_text_kprobe
+    bpf_text = bpf_text.replace('READ_CACHE_FIELD',
+        'bpf_probe_read_kernel(&dst, sizeof(dst), &cachep->field)')
+
 if debug or args.ebpf:
     print(bpf_text)
     if args.ebpf:
@@ -205,13 +311,27 @@ if debug or args.ebpf:
 
 # initialize BPF
 b = BPF(text=bpf_text)
+if not is_support_kfunc and not is_support_raw_tp:
+    for func in alloc_funcs:
+        b.attach_kprobe(event=func, fn_name="trace_cache_alloc")
 # check whether hash table batch ops is supported
 htab_batch_ops = True if BPF.kernel_struct_has_field(b'bpf_map_ops',
         b'map_lookup_and_delete_batch') == 1 else False
 
+by_size = itemgetter(2)
+
+def cache_name(names, k):
+    try:
+        return names[k].name
+    except KeyError:
+        return b"0x%x" % k.cache
+
 print('Tracing... Output every %d secs. Hit Ctrl-C to end' % interval)
 
 # output
+counts = b.get_table("counts")
+names = b.get_table("names")
+loadavg_fd = os.open(loadavg, os.O_RDONLY)
 exiting = 0
 while 1:
     try:
@@ -221,24 +341,25 @@ while 1:
 
     # header
     if clear:
-        call("clear")
+        if ansi_clear:
+            printb(clear_seq, nl=0)
+        else:
+            call("clear")
     else:
         print()
-    with open(loadavg) as stats:
-        print("%-8s loadavg: %s" % (strftime("%H:%M:%S"), stats.read()))
-    print("%-32s %6s %10s" % ("CACHE", "ALLOCS", "BYTES"))
+    print("%-8s loadavg: %s" % (strftime("%H:%M:%S"),
+                                os.pread(loadavg_fd, 128, 0).decode()))
+    print(header)
 
     # by-TID output
-    counts = b.get_table("counts")
-    line = 0
-    for k, v in reversed(sorted(counts.items_lookup_and_delete_batch()
-                                if htab_batch_ops else counts.items(),
-                                key=lambda counts: counts[1].size)):
-        printb(b"%-32s %6d %10d" % (k.name, v.count, v.size))
-
-        line += 1
-        if line >= maxrows:
-            break
+    # sum the per-CPU values of each cache
+    totals = [(k, sum(c.count for c in v), sum(c.size for c in v))
+              for k, v in (counts.items_lookup_and_delete_batch()
+                           if htab_batch_ops else counts.items())]
+    rows = [row_fmt % (cache_name(names, k), count, size)
+            for k, count, size in heapq.nlargest(maxrows, totals, key=by_size)]
+    if rows:
+        printb(b"\n".join(rows))
     if not htab_batch_ops:
         counts.clear()
 